@@ -4,8 +4,9 @@ and data loading functions to work with intended dataset.
 '''
 
 
-import os, time
+import os, time, warnings, operator
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
@@ -13,7 +14,9 @@ from tqdm import tqdm
 
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader, Dataset
+import torch.nn.functional as F
+from torch.utils.data import (DataLoader, Dataset, BatchSampler,
+                              RandomSampler, SequentialSampler)
 
 
 depth = 16      # initial depth to convolve channels into
@@ -22,32 +25,102 @@ stride = 2      # stride for conv
 pad = 1         # padding added for conv
 
 
+def _fuse_conv_bn(conv, bn):
+    """
+    Fold an eval mode batchnorm into the weights of the preceding (transposed) convolution
+    w' = w * gamma / sqrt(var + eps)
+    b' = (b - mean) * gamma / sqrt(var + eps) + beta
+    """
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        if isinstance(conv, nn.ConvTranspose1d):
+            # weight [in_channels, out_channels / groups, filt_size], out channels are per group
+            weight = conv.weight.view(conv.groups, -1, conv.out_channels // conv.groups, conv.weight.shape[-1])
+            weight.mul_(scale.view(conv.groups, 1, -1, 1))
+        else:
+            # weight [out_channels, in_channels / groups, filt_size]
+            conv.weight.mul_(scale.view(-1, 1, 1))
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        conv.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias)
+
+
 class VAE1D(nn.Module):
-    def __init__(self, size, n_channels, n_latent=100):
+    def __init__(self, size, n_channels, n_latent=100, separable=False, mixed_precision=False):
         
         # Model setup
         #############
         super(VAE1D, self).__init__()
-        self.size = size
+        self.size = size = operator.index(size)  # accepts numpy ints, rejects floats
         self.n_channels = n_channels
         self.n_latent = n_latent
+        self.separable = separable  # depthwise-separable pyramid convs
+        self.mixed_precision = mixed_precision  # opt-in bfloat16 convs when on GPU, e.g. for training
+        self._bn_fused = False  # set by fuse_bn
         
-        n = np.log2(self.size)
-        assert n == round(n), 'Vector size must be a power of 2'  # restrict input sizes permitted
-        assert n >= 3, 'Vector size must be at least 8'           # low dimensional data won't work well
-        n = int(n)
+        # Restrict input sizes permitted, low dimensional data won't work well
+        if size < 8 or size & (size - 1):
+            raise ValueError('Vector size must be a power of 2 >= 8')
+        n = size.bit_length() - 1
 
         # Encoder - first half of VAE
         #############################
-        self.encoder = nn.Sequential()  
+        self.encoder = self._build_encoder(n)
+
+        # Latent representation
+        #######################
+        # Convolve the encoded vector into the latent space, mu and log variance
+        # are computed together and split along the channels
+        max_depth = depth * 2 ** (n - 3)
+        self.conv_mu_logvar = nn.Conv1d(max_depth, 2 * n_latent, filt_size)
+        
+        
+        # Decoder - second half of VAE
+        ##############################
+        self.decoder = self._build_decoder(n)
+
+        # Model weights init
+        ####################
+        # Randomly initialize the model weights using kaiming method
+        # Reference: "Delving deep into rectifiers: Surpassing human-level
+        # performance on ImageNet classification" - He, K. et al. (2015)
+        for m in self.modules():
+            if isinstance(m, nn.Conv1d):
+                nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
+            elif isinstance(m, nn.BatchNorm1d):
+                nn.init.constant_(m.weight, 1)
+                nn.init.constant_(m.bias, 0)
+            elif isinstance(m, nn.Linear):
+                nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
+        # Init mu and logvar halves of the fused latent conv separately, so each
+        # keeps the fan_out (and weight scale) of a standalone n_latent conv
+        for half in self.conv_mu_logvar.weight.data.chunk(2, dim=0):
+            nn.init.kaiming_normal_(half, mode='fan_out', nonlinearity='relu')
+
+        # Input shapes are fixed for a given model, so let cuDNN benchmark
+        # the available conv algorithms once and reuse the fastest
+        torch.backends.cudnn.benchmark = True
+
+        # Compile the conv stacks with TorchScript to skip the per-layer Python
+        # dispatch of nn.Sequential and let the JIT fuse elementwise ops
+        # The first calls run the JIT profiler, time from the third call onwards
+        if torch.cuda.is_available() and hasattr(torch._C, '_jit_set_nvfuser_enabled'):
+            torch._C._jit_set_nvfuser_enabled(True)
+        self.encoder = torch.jit.script(self.encoder)
+        self.decoder = torch.jit.script(self.decoder)
+
+    def _build_encoder(self, n):
+        """
+        Build the encoder conv stack for vectors of size 2 ** n
+        """
+        encoder = nn.Sequential()  
         # input: n_channels x size
         # ouput: depth x conv_size
         # conv_size = (size - filt_size + 2 * pad) / stride + 1
-        self.encoder.add_module('input-conv', nn.Conv1d(n_channels, depth,
-                                                        filt_size, stride, pad,
-                                                        bias=True))
+        encoder.add_module('input-conv', nn.Conv1d(self.n_channels, depth,
+                                                   filt_size, stride, pad,
+                                                   bias=True))
         # TODO - add batchnorm?
-        self.encoder.add_module('input-relu', nn.ReLU(inplace=True))
+        encoder.add_module('input-relu', nn.ReLU(inplace=True))
         
         # Add conv layer for each power of 2 over 3 (min size)
         # Pyramid strategy with batch normalization added
@@ -57,61 +130,67 @@ class VAE1D(nn.Module):
             # i_depth = o_depth of previous layer
             i_depth = depth * 2 ** i
             o_depth = depth * 2 ** (i + 1)
-            self.encoder.add_module(f'pyramid_{i_depth}-{o_depth}_conv',
-                                    nn.Conv1d(i_depth, o_depth, filt_size, stride, pad, bias=True))
-            self.encoder.add_module(f'pyramid_{o_depth}_batchnorm',
-                                    nn.BatchNorm1d(o_depth))
-            self.encoder.add_module(f'pyramid_{o_depth}_relu',
-                                    nn.ReLU(inplace=True))
-        
-        # Latent representation
-        #######################
-        # Convolve the encoded vector into the latent space, once for mu and once for log variance
+            if self.separable:
+                # Depthwise conv over length then pointwise conv over channels
+                encoder.add_module(f'pyramid_{i_depth}_depthwise-conv',
+                                   nn.Conv1d(i_depth, i_depth, filt_size, stride, pad,
+                                             groups=i_depth, bias=True))
+                encoder.add_module(f'pyramid_{i_depth}_depthwise-batchnorm',
+                                   nn.BatchNorm1d(i_depth))
+                encoder.add_module(f'pyramid_{i_depth}_depthwise-relu',
+                                   nn.ReLU(inplace=True))
+                encoder.add_module(f'pyramid_{i_depth}-{o_depth}_conv',
+                                   nn.Conv1d(i_depth, o_depth, 1, bias=True))
+            else:
+                encoder.add_module(f'pyramid_{i_depth}-{o_depth}_conv',
+                                   nn.Conv1d(i_depth, o_depth, filt_size, stride, pad, bias=True))
+            encoder.add_module(f'pyramid_{o_depth}_batchnorm',
+                               nn.BatchNorm1d(o_depth))
+            encoder.add_module(f'pyramid_{o_depth}_relu',
+                               nn.ReLU(inplace=True))
+        return encoder
+
+    def _build_decoder(self, n):
+        """
+        Build the decoder conv stack for vectors of size 2 ** n
+        """
         max_depth = depth * 2 ** (n - 3)
-        self.conv_mu = nn.Conv1d(max_depth, n_latent, filt_size)
-        self.conv_logvar = nn.Conv1d(max_depth, n_latent, filt_size)
-        
-        
-        # Decoder - second half of VAE
-        ##############################
-        self.decoder = nn.Sequential()
+        decoder = nn.Sequential()
         # input: max_depth x conv_size
         # output: n_latent x conv_size
         # default stride=1, pad=0 for this layer
-        self.decoder.add_module('input-conv', nn.ConvTranspose1d(n_latent, max_depth, filt_size, bias=True))
-        self.decoder.add_module('input-batchnorm', nn.BatchNorm1d(max_depth))
-        self.decoder.add_module('input-relu', nn.ReLU(inplace=True))
+        decoder.add_module('input-conv', nn.ConvTranspose1d(self.n_latent, max_depth, filt_size, bias=True))
+        decoder.add_module('input-batchnorm', nn.BatchNorm1d(max_depth))
+        decoder.add_module('input-relu', nn.ReLU(inplace=True))
     
         # Reverse the convolution pyramids used in the encoder
         for i in range(n - 3, 0, -1):
             i_depth = depth * 2 ** i
             o_depth = depth * 2 ** (i - 1)
-            self.decoder.add_module(f'pyramid_{i_depth}-{o_depth}_conv',
-                                    nn.ConvTranspose1d(i_depth, o_depth, filt_size, stride, pad, bias=True))
-            self.decoder.add_module(f'pyramid_{o_depth}_batchnorm',
-                                    nn.BatchNorm1d(o_depth))
-            self.decoder.add_module(f'pyramid_{o_depth}_relu', nn.ReLU(inplace=True))
+            if self.separable:
+                decoder.add_module(f'pyramid_{i_depth}_depthwise-conv',
+                                   nn.ConvTranspose1d(i_depth, i_depth, filt_size, stride, pad,
+                                                      groups=i_depth, bias=True))
+                decoder.add_module(f'pyramid_{i_depth}_depthwise-batchnorm',
+                                   nn.BatchNorm1d(i_depth))
+                decoder.add_module(f'pyramid_{i_depth}_depthwise-relu',
+                                   nn.ReLU(inplace=True))
+                decoder.add_module(f'pyramid_{i_depth}-{o_depth}_conv',
+                                   nn.Conv1d(i_depth, o_depth, 1, bias=True))
+            else:
+                decoder.add_module(f'pyramid_{i_depth}-{o_depth}_conv',
+                                   nn.ConvTranspose1d(i_depth, o_depth, filt_size, stride, pad, bias=True))
+            decoder.add_module(f'pyramid_{o_depth}_batchnorm',
+                               nn.BatchNorm1d(o_depth))
+            decoder.add_module(f'pyramid_{o_depth}_relu', nn.ReLU(inplace=True))
         
         # Final transposed convolution to return to vector size
         # TODO: ?No final activation to allow unbounded numerical output
-        self.decoder.add_module('output-conv', nn.ConvTranspose1d(depth, n_channels,
-                                                                  filt_size, stride, pad,
-                                                                  bias=True))
-        # self.decoder.add_module('output-sigmoid', nn.Sigmoid())
-
-        # Model weights init
-        ####################
-        # Randomly initialize the model weights using kaiming method
-        # Reference: "Delving deep into rectifiers: Surpassing human-level
-        # performance on ImageNet classification" - He, K. et al. (2015)
-        for m in self.modules():
-            if isinstance(m, nn.Conv1d):
-                nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
-            elif isinstance(m, nn.BatchNorm1d):
-                nn.init.constant_(m.weight, 1)
-                nn.init.constant_(m.bias, 0)
-            elif isinstance(m, nn.Linear):
-                nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
+        decoder.add_module('output-conv', nn.ConvTranspose1d(depth, self.n_channels,
+                                                             filt_size, stride, pad,
+                                                             bias=True))
+        # decoder.add_module('output-sigmoid', nn.Sigmoid())
+        return decoder
 
     def encode(self, trans):
         """
@@ -121,8 +200,10 @@ class VAE1D(nn.Module):
                 logvar [batch_size, n_latent, 1]
         """
         output = self.encoder(trans)
-        output = output.squeeze(-1)
-        return [self.conv_mu(output), self.conv_logvar(output)]
+        # The conv stacks are scripted, call the latent conv functionally as well
+        # to skip the python module call overhead
+        output = F.conv1d(output, self.conv_mu_logvar.weight, self.conv_mu_logvar.bias)
+        return output.chunk(2, dim=1)
 
     def sample(self, mu, logvar):
         """
@@ -132,9 +213,9 @@ class VAE1D(nn.Module):
         output: gen    [batch_size, n_latent, 1]
         """
         if self.training:
-            std = torch.exp(0.5 * logvar)
-            gen = torch.randn_like(std)
-            return gen.mul(std).add_(mu)
+            # exp_ is applied to the scaled copy so logvar is intact for the KL term
+            std = logvar.mul(0.5).exp_()
+            return torch.addcmul(mu, std, torch.randn_like(std))
         else:
             return mu  # most likely representation
 
@@ -154,10 +235,23 @@ class VAE1D(nn.Module):
                mu        [batch_size, n_latent]
                logvar    [batch_size, n_latent]
         """
+        # Conv kernels expect a dense [batch, channel, length] layout, no-op
+        # when the batch already arrives contiguous from the dataloader
+        trans = trans.contiguous()
+        # With mixed_precision, run the conv stack in bfloat16 on GPU, outputs are
+        # cast back to the input dtype so the loss (logvar.exp() in particular) is
+        # computed at full precision. Off by default, existing thresholds are fp32 calibrated
+        if self.mixed_precision and trans.is_cuda:
+            with torch.autocast('cuda', dtype=torch.bfloat16):
+                gen_trans, mu, logvar = self._forward(trans)
+            gen_trans, mu, logvar = gen_trans.to(trans.dtype), mu.to(trans.dtype), logvar.to(trans.dtype)
+        else:
+            gen_trans, mu, logvar = self._forward(trans)
+        return gen_trans, mu.squeeze(-1), logvar.squeeze(-1)
+
+    def _forward(self, trans):
         mu, logvar = self.encode(trans)
         gen = self.sample(mu, logvar)
-        mu = mu.squeeze(-1)
-        logvar = logvar.squeeze(-1)
         return self.decode(gen), mu, logvar
 
     def demo(self, batch_size=1):
@@ -174,12 +268,78 @@ class VAE1D(nn.Module):
         print(f'Decoded (output) size: {D.shape}')
         return X, E, L, D
     
+    def fuse_bn(self):
+        """
+        Fold each batchnorm into the preceding convolution for faster inference
+        The batchnorm layers are replaced by identities, only call in eval mode
+        once training is done. Calling it again is a no-op
+        """
+        if self.training:
+            raise RuntimeError('Batchnorm can only be fused in eval mode, call model.eval() first')
+        if self._bn_fused:
+            return self
+        n = self.size.bit_length() - 1
+        weight = self.conv_mu_logvar.weight
+        for name, build in (('encoder', self._build_encoder), ('decoder', self._build_decoder)):
+            # Scripted stacks can't be edited, rebuild them in python and load the weights
+            stack = build(n).to(device=weight.device, dtype=weight.dtype).eval()
+            stack.load_state_dict(getattr(self, name).state_dict())
+            layers = list(stack.named_children())
+            for (_, conv), (bn_name, bn) in zip(layers[:-1], layers[1:]):
+                if isinstance(bn, nn.BatchNorm1d):
+                    _fuse_conv_bn(conv, bn)
+                    setattr(stack, bn_name, nn.Identity())
+            setattr(self, name, torch.jit.script(stack))
+        self._bn_fused = True
+        return self
+
+    def load_state_dict(self, state_dict, strict=True):
+        # Upgrade checkpoints saved with separate conv_mu and conv_logvar layers
+        state_dict = dict(state_dict)
+        for param in ('weight', 'bias'):
+            mu_key, logvar_key = f'conv_mu.{param}', f'conv_logvar.{param}'
+            if mu_key in state_dict and logvar_key in state_dict:
+                state_dict[f'conv_mu_logvar.{param}'] = torch.cat([state_dict.pop(mu_key),
+                                                                   state_dict.pop(logvar_key)])
+        return super().load_state_dict(state_dict, strict)
+
     def to(self, device):
         # Override to save device property
         self.device = device
         return super().to(device)
 
     
+def _vae_loss(gen_trans, trans, mu, logvar, beta, reduce):
+    # type: (Tensor, Tensor, Tensor, Tensor, float, bool) -> Tuple[Tensor, Tensor, Tensor]
+    # Reconstruction loss
+    # TODO: why the 0.5 term? not a log
+    if reduce:
+        gen_err = 0.5 * F.mse_loss(gen_trans, trans, reduction='sum') / trans.shape[0]
+    else:
+        gen_err = 0.5 * F.mse_loss(gen_trans, trans, reduction='none').flatten(1).sum(-1)
+
+    # Regularizer
+    # KL(q || p) = -log_sigma + sigma^2/2 + mu^2/2 - 1/2
+    # K-L divergence of learned pdf to standard gaussian N(0, 1)
+    # expm1(x) = exp(x) - 1, more accurate as logvar -> 0
+    KL = 0.5 * (torch.expm1(logvar) - logvar + mu * mu).sum(-1)
+    if reduce:
+        KL = torch.mean(KL)
+
+    loss = gen_err + beta * KL
+    return loss, gen_err, KL
+
+
+# Fuse the elementwise chain and reductions of the loss into as few kernels
+# as possible, with torch.compile where available (torch >= 2.0) and the
+# TorchScript fuser otherwise (e.g. the pinned torch 1.10)
+# Note the first couple of calls are slow while compiling, warm up before timing
+if hasattr(torch, 'compile'):
+    _vae_loss = torch.compile(_vae_loss, fullgraph=True)
+else:
+    _vae_loss = torch.jit.script(_vae_loss)
+
+
 class VAE1DLoss(nn.Module):
 
     def __init__(self, beta=1):
@@ -188,32 +348,75 @@ class VAE1DLoss(nn.Module):
 
     def forward(self, gen_trans, trans, mu, logvar, reduce=True):
         """
-        input:  gen_trans [batch_size, n_channels, size, size]
-                trans     [batch_size, n_channels, size, size]
+        input:  gen_trans [batch_size, n_channels, size]
+                trans     [batch_size, n_channels, size]
                 mu        [batch_size, n_latent]
                 logvar    [batch_size, n_latent]
         output: loss      scalar (-ELBO)
                 loss_desc {'KL', 'logp'}
         """
-        # Reconstruction loss
-        batch_size = trans.shape[0]
-        gen_err = (trans - gen_trans).pow(2).reshape(batch_size, -1)
-        gen_err = 0.5 * torch.sum(gen_err, dim=-1)  # TODO: why the 0.5 term? not a log
-        if reduce:
-            gen_err = torch.mean(gen_err)
-        
-        # Regularizer
-        # KL(q || p) = -log_sigma + sigma^2/2 + mu^2/2 - 1/2
-        # K-L divergence of learned pdf to standard gaussian N(0, 1)
-        KL = (-logvar + logvar.exp() + mu.pow(2) - 1) * 0.5
-        KL = torch.sum(KL, dim=-1)
-        if reduce:
-            KL = torch.mean(KL)
-
-        loss = gen_err + self.beta * KL
+        loss, gen_err, KL = _vae_loss(gen_trans, trans, mu, logvar, float(self.beta), reduce)
         return loss, {'KL': KL, 'logp': -gen_err}
 
 
+def _list_dir(path):
+    with os.scandir(path) as it:
+        return sorted(entry.name for entry in it)  # fixed order to match the packed array
+
+
+def _list_classes(path):
+    with os.scandir(path) as it:
+        return sorted(entry.name for entry in it if entry.is_dir())
+
+
+def _class_mtimes(path, classes):
+    # A folder's modification time changes whenever a sample is added or removed
+    return np.array([os.stat(path / c).st_mtime_ns for c in classes], dtype=np.int64)
+
+
+def _build_index(path, rebuild=False):
+    """
+    Return the sample names, targets and classes of a dataset folder
+    The listing is cached to _index.npz in the folder and rebuilt automatically
+    when a class folder is added, removed or modified, or when rebuild is set
+    output: names   [n_samples] file name of each sample
+            targets [n_samples] class index of each sample
+            classes [n_classes] sorted class folder names
+    """
+    path = Path(path)
+    index_path = path / '_index.npz'
+    classes = _list_classes(path)
+    mtimes = _class_mtimes(path, classes)  # taken before listing so later changes invalidate it
+    if index_path.is_file() and not rebuild:
+        with np.load(index_path) as index:
+            if ('mtimes' in index and index['classes'].tolist() == classes
+                    and np.array_equal(index['mtimes'], mtimes)):
+                return index['names'], index['targets'], classes
+
+    # List classes in parallel, directory listing is IO bound and releases the GIL
+    with ThreadPoolExecutor(max_workers=max(1, min(16, len(classes)))) as ex:
+        names = list(ex.map(_list_dir, [path / c for c in classes]))
+    targets = np.fromiter((i for i, ns in enumerate(names) for _ in ns),
+                          dtype=np.int64, count=sum(len(ns) for ns in names))
+    names = np.array([n for ns in names for n in ns], dtype=str)
+
+    # Write to a temporary file first so concurrent loaders never read a partial index
+    tmp_path = path / f'_index.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, names=names, targets=targets,
+                     classes=np.array(classes, dtype=str), mtimes=mtimes)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        # e.g. read-only storage, the listing is still usable without the cache
+        warnings.warn(f"Could not cache the file listing to {index_path}: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    return names, targets, classes
+
+
 class TransientDataset(Dataset):
     
     def __init__(self, data_path, normals):
@@ -222,50 +425,141 @@ class TransientDataset(Dataset):
         self.mu = normals[:, 0][:, None]  # want arrays, not vectors
         self.sigma = normals[:, 1][:, None]
         
-        self.classes = sorted(os.listdir(self.path))
-        self.names = []
-        self.targets =[]
-        for i, c in enumerate(self.classes):
-            names = os.listdir(self.path / c)
-            targets = [i] * len(names)
-            self.names.extend(names)
-            self.targets.extend(targets)
+        # Flat parallel arrays of sample file names and class indices
+        self.names, self.targets, self.classes = _build_index(self.path)
+        # Join the sample paths once rather than building Path objects per item
+        # Kept as a numpy array like names, a list of str objects would be
+        # copied into every forked worker as their refcounts are touched
+        root = str(self.path)
+        self.full_paths = np.array([os.path.join(root, self.classes[t], n)
+                                    for n, t in zip(self.names, self.targets)], dtype=str)
+
+        # Use the pre-normalized array from pack_dataset if available
+        # Opened read-only so dataloader workers share the same pages
+        mm_path = self.path / 'all.npy'
+        self.mm = None
+        if mm_path.is_file():
+            if self._packed_is_current(normals):
+                self.mm = np.load(mm_path, mmap_mode='r')
+            else:
+                # Rows would no longer line up with the labels or normalization
+                warnings.warn(f"{mm_path} was packed from different samples or normals, "
+                              "ignoring it. Re-run pack_dataset.")
         
+    def _packed_is_current(self, normals):
+        # all_index.npz records the listing and normals all.npy was packed with
+        packed_path = self.path / 'all_index.npz'
+        if not packed_path.is_file():
+            return False
+        with np.load(packed_path) as packed:
+            return (np.array_equal(packed['names'], self.names)
+                    and np.array_equal(packed['targets'], self.targets)
+                    and np.array_equal(packed['normals'], normals))
+
     def __len__(self):
         return len(self.names)
     
     def __getitem__(self, index):
-        name = self.names[index]
         target = self.targets[index]
-        path = self.path / self.classes[target] / name
-        return (torch.Tensor(self.norm(np.load(path))), target)
+        if self.mm is not None:
+            if isinstance(index, (list, np.ndarray)):
+                # Whole batch from a BatchSampler, read in one sorted pass over the
+                # memmap then put back in the requested order
+                index = np.asarray(index)
+                order = np.argsort(index)
+                batch = np.empty((len(index),) + self.mm.shape[1:], dtype=np.float32)
+                batch[order] = self.mm[index[order]]
+                return (torch.from_numpy(batch), torch.from_numpy(self.targets[index]))
+            return (torch.from_numpy(np.array(self.mm[index], dtype=np.float32)), target)
+        return (torch.Tensor(self.norm(np.load(self.full_paths[index]))), target)
     
     def __repr__(self):
-        ret = []
-        for i, c in enumerate(self.classes):
-            ret.append(f"{c}: {sum([1 if t == i else 0 for t in self.targets])}")
-        return ', '.join(ret)
+        counts = np.bincount(self.targets, minlength=len(self.classes))
+        return ', '.join(f"{c}: {n}" for c, n in zip(self.classes, counts))
         
     def index(self, name):
         name = str(name)
-        if index[-4:] != '.npy':
-            index = index + '.npy'
-        return self.names.index(index)
+        if name[-4:] != '.npy':
+            name = name + '.npy'
+        return np.where(self.names == name)[0][0]
     
     def norm(self, arr):
         # Normalize sensor channels to N(0, 1)
         return (arr - self.mu) / self.sigma
 
 
-def load_datasets(data_path, batch_size=32):
+def split_paths(data_path):
     """
-    Load the transient datasets from train and test into dataloaders
-    Must have normals for each sensor channel saved to normals.npy
+    Return the train, validation and test folders of a transient dataset
     """
     data_path = Path(data_path)
     train_path = data_path / 'train/train/'
     val_path = data_path / 'train/val/'
     test_path = data_path / 'test/'
+    return train_path, val_path, test_path
+
+
+def pack_dataset(data_path, normals, dtype=np.float32):
+    """
+    Stack all normalized transients in a folder into a single array saved to all.npy
+    The names, targets and normals used are saved to all_index.npz alongside it
+    Only needs to be run once, TransientDataset will then read from it as a memmap
+    Re-run if samples are added or removed or the normals change, until then the
+    dataset falls back to loading each sample
+    """
+    _build_index(data_path, rebuild=True)  # never pack from a stale listing
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # a stale all.npy is about to be replaced
+        ds = TransientDataset(data_path, normals)
+    ds.mm = None  # always pack from the raw samples
+    shape = (len(ds),) + tuple(ds[0][0].shape)
+    data_path = Path(data_path)
+    # Write to temporary files first so concurrent loaders never map a partial array
+    # If a loader sees the new array with the old all_index.npz it just falls back
+    tmp_path = data_path / f'all.{os.getpid()}.tmp'
+    mm = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape)
+    for i in tqdm(range(len(ds))):
+        mm[i] = ds[i][0].numpy()
+    mm.flush()
+    del mm
+    tmp_index_path = data_path / f'all_index.{os.getpid()}.tmp'
+    with open(tmp_index_path, 'wb') as file:
+        np.savez(file, names=ds.names, targets=ds.targets, normals=normals)
+    os.replace(tmp_path, data_path / 'all.npy')
+    os.replace(tmp_index_path, data_path / 'all_index.npz')
+
+
+def pack_datasets(data_path, dtype=np.float32):
+    """
+    Pack the train, validation and test datasets, see pack_dataset
+    Must have normals for each sensor channel saved to normals.npy
+    """
+    data_path = Path(data_path)
+    normals = np.load(data_path.parent / 'normals.npy')
+    for path in split_paths(data_path):
+        pack_dataset(path, normals, dtype)
+
+
+def _data_loader(ds, batch_size, shuffle, **loader_args):
+    if ds.mm is None:
+        return DataLoader(ds, batch_size=batch_size, shuffle=shuffle, **loader_args)
+    # Packed datasets are indexed a batch at a time, so each worker fetches a
+    # batch with a single memmap read instead of batch_size separate ones
+    sampler = RandomSampler(ds) if shuffle else SequentialSampler(ds)
+    sampler = BatchSampler(sampler, batch_size, drop_last=False)
+    return DataLoader(ds, sampler=sampler, batch_size=None, **loader_args)
+
+
+def load_datasets(data_path, batch_size=32, num_workers=4):
+    """
+    Load the transient datasets from train and test into dataloaders
+    Must have normals for each sensor channel saved to normals.npy
+    Run pack_datasets once beforehand to avoid loading each sample from disk
+    Batches are pinned when a GPU is available, copy them with
+    X.to(device, non_blocking=True) to overlap the transfer with compute
+    """
+    data_path = Path(data_path)
+    train_path, val_path, test_path = split_paths(data_path)
     
     normals = np.load(data_path.parent / 'normals.npy')
 
@@ -274,14 +568,68 @@ def load_datasets(data_path, batch_size=32):
     test_ds = TransientDataset(test_path, normals)
     
     loader_args = {'shuffle': True,
-                   'num_workers': 4}
-    train_dl = DataLoader(train_ds, batch_size=batch_size, **loader_args)
-    val_dl = DataLoader(val_ds, batch_size=batch_size, **loader_args)
-    test_dl = DataLoader(test_ds, batch_size=1, ** loader_args)
+                   'num_workers': num_workers,
+                   'pin_memory': torch.cuda.is_available()}  # pinning only helps GPU copies
+    if num_workers > 0:
+        # Keep workers alive between epochs, larger prefetch only grows pinned memory
+        loader_args.update({'persistent_workers': True,
+                            'prefetch_factor': 2})
+    train_dl = _data_loader(train_ds, batch_size, **loader_args)
+    val_dl = _data_loader(val_ds, batch_size, **loader_args)
+    test_dl = _data_loader(test_ds, 1, **loader_args)
     
     return train_dl, val_dl, test_dl
 
 
+class CUDAPrefetcher(object):
+    """
+    Iterate over a dataloader, copying the next batch to the device on a side
+    CUDA stream so the copy overlaps with compute on the current batch
+    Use with the pinned loaders from load_datasets: for X, y in CUDAPrefetcher(dl, device)
+    Falls back to plain copies on CPU
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iter = iter(self.loader)
+        self.preload()
+        return self
+
+    def preload(self):
+        try:
+            batch = next(self.iter)
+        except StopIteration:
+            self.next_batch = None
+            return
+        if self.stream is None:
+            self.next_batch = tuple(t.to(self.device) for t in batch)
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_batch = tuple(t.to(self.device, non_blocking=True) for t in batch)
+
+    def next(self):
+        batch = self.next_batch
+        if batch is None:
+            raise StopIteration
+        if self.stream is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(self.stream)
+            # The batch was allocated on the side stream, record its use on the
+            # current stream so the allocator doesn't recycle it too early
+            for t in batch:
+                t.record_stream(current)
+        self.preload()
+        return batch
+
+    __next__ = next
+
+
 # Convenience classes
 class StopWatch(object):
     def __init__(self):
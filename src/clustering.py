@@ -52,7 +52,7 @@ def score(dl, model, criterion):
     model.eval()
     with torch.no_grad():
         for i, (X, y) in enumerate(tqdm(dl)):
-            X = X.to(device)
+            X = X.to(device, non_blocking=True)
             for j in range(X.shape[0]):
                 data = X[j, :].unsqueeze(0)
                 cls = classes[y[j].item()]
@@ -82,7 +82,7 @@ def compute_latents(dl, model):
     model.eval()
     with torch.no_grad():
         for i, (X, y) in enumerate(tqdm(dl)):
-            X = X.to(device)
+            X = X.to(device, non_blocking=True)
             for j in range(X.shape[0]):
                 data = X[j, :].unsqueeze(0)
                 X_hat, mu, logvar = model(data)
@@ -104,7 +104,7 @@ def compute_latent_and_loss(dl, model, criterion):
     model.eval()
     with torch.no_grad():
         for i, (X, y) in enumerate(tqdm(dl)):
-            X = X.to(device)
+            X = X.to(device, non_blocking=True)
             for j in range(X.shape[0]):
                 data = X[j, :].unsqueeze(0)
                 X_hat, mu, logvar = model(data)
@@ -71,7 +71,7 @@ def compute_scores(dl, model, criterion):
     model.eval()
     with torch.no_grad():
         for i, (X, y) in enumerate(tqdm(dl)):
-            X = X.to(device)
+            X = X.to(device, non_blocking=True)
             for j in range(X.shape[0]):
                 data = X[j, :].unsqueeze(0)
                 clss = classes[y[j].item()]
@@ -94,7 +94,7 @@ def compute_latents(dl, model, max_n=100):
     model.eval()
     with torch.no_grad():
         for i, (X, y) in enumerate(tqdm(dl)):
-            X = X.to(device)
+            X = X.to(device, non_blocking=True)
             for j in range(X.shape[0]):
                 data = X[j, :].unsqueeze(0)
                 _, mu, _ = model(data)